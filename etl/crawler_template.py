@@ -0,0 +1,439 @@
+# -*- encoding: utf8 -*-
+"""declarative crawler template
+
+a crawler spec (dict or YAML/JSON file) describe section listing pages,
+link selectors and output fields. create_crawler generate a registered
+ETLCrawler subclass from spec, all generated crawlers share one engine:
+
+    extract:   fetch each listing page once, collect article links of every
+               section, dedup links and fetch each article once.
+    transform: parse each article once, fan the row out to every section
+               which link to it, write one csv per section.
+    load:      read csv of each section, pass rows to load_rows.
+
+spec:
+    name: new_york_times               # registered class name
+    execute_cron_time: "00 20 * * *"   # optional ETLCrawler attributes
+    run_retention: 604800              # timedelta attributes in seconds
+    start_date: 2018-01-11             # datetime attributes as YYYY-MM-DD
+    base_url: https://www.nytimes.com  # join relative links
+    sections:
+        economy:
+            url: https://www.nytimes.com/section/business/economy
+            link_selector: section#collection-business-economy section li a
+    fields:                            # csv columns in order
+        - name: title
+          selector: [h1 span, "#headline"]  # first non-empty selector win
+        - name: publish_date
+          selector: meta[itemprop=datePublished]
+          attr: content                # attribute instead of text
+          split: T                     # keep text before separator
+        - name: context
+          selector: p.story-body-text
+          many: true                   # join all matched with tab
+        - name: url
+          selector: html
+          attr: itemid
+          required: true               # page without it is skipped
+        - name: summary
+          parse: parse_summary         # crawler method (soup) -> text,
+                                       # given by create_crawler attrs
+    layouts:                           # optional, first matched layout
+        - match: div#app               # replace extraction rule of fields,
+                                       # name/required/default are kept
+          fields:
+              title:
+                  selector: h1 span
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+import requests
+import requests.exceptions
+from bs4 import BeautifulSoup
+from etl_register import ETLCrawler, ETLCrawlerRegistryHolder
+
+try:
+    from urlparse import urldefrag, urljoin
+except ImportError:
+    from urllib.parse import urldefrag, urljoin
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+FILE_ROOT = os.path.join("/home/airflow/gcs", 'data')
+INDEX_FILE_NAME = 'index.json'
+FETCH_RETRIES = 3
+# field keys kept when layout replace field's extraction rule
+FIELD_KEPT_KEYS = ('name', 'required', 'default')
+# spec keys which are copied to generated class as ETLCrawler attributes
+CRAWLER_ATTRIBUTES = ('execute_cron_time', 'retries', 'retry_delay_time',
+                      'start_date', 'execution_timeout', 'max_active_runs',
+                      'run_retention', 'memory_limit_mb',
+                      'memory_spill_ratio')
+# spec gives these in seconds
+TIMEDELTA_ATTRIBUTES = ('retry_delay_time', 'execution_timeout',
+                        'run_retention')
+# spec gives these as YYYY-MM-DD
+DATETIME_ATTRIBUTES = ('start_date',)
+
+
+def load_spec(path):
+    """load crawler spec from YAML or JSON file
+
+    Args:
+        path (string): spec file path, .yaml/.yml need PyYAML
+
+    Returns:
+        dict: crawler spec
+    """
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('PyYAML is required to load ' + path)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def validate_spec(spec):
+    """check required keys of crawler spec
+
+    Args:
+        spec (dict): crawler spec
+
+    Raises:
+        ValueError: spec is invalid
+    """
+    for key in ('name', 'sections', 'fields'):
+        if not spec.get(key):
+            raise ValueError('crawler spec require {}'.format(key))
+    for section, section_spec in spec['sections'].items():
+        for key in ('url', 'link_selector'):
+            if not section_spec.get(key):
+                raise ValueError('section {} require {}'.format(section, key))
+    names = set()
+    for field in spec['fields']:
+        if not field.get('name') or \
+                not (field.get('selector') or field.get('parse')):
+            raise ValueError('field require name and selector or parse')
+        names.add(field['name'])
+    for layout in spec.get('layouts', []):
+        if not layout.get('match') or not layout.get('fields'):
+            raise ValueError('layout require match and fields')
+        for name, field in layout['fields'].items():
+            if name not in names:
+                raise ValueError('layout field {} is not in fields'.format(
+                    name))
+            if not (field.get('selector') or field.get('parse')):
+                raise ValueError('layout field {} require selector or '
+                                 'parse'.format(name))
+
+
+def get_crawler_attributes(spec):
+    """return ETLCrawler attributes of spec, convert YAML/JSON values
+
+    Args:
+        spec (dict): crawler spec
+
+    Raises:
+        ValueError: attribute value can not be converted
+
+    Returns:
+        dict: class attributes
+    """
+    attributes = {}
+    for key in CRAWLER_ATTRIBUTES:
+        if key not in spec:
+            continue
+        value = spec[key]
+        if key in TIMEDELTA_ATTRIBUTES and value is not None and \
+                not isinstance(value, datetime.timedelta):
+            if isinstance(value, bool) or \
+                    not isinstance(value, (int, float)):
+                raise ValueError('{} should be seconds'.format(key))
+            value = datetime.timedelta(seconds=value)
+        elif key in DATETIME_ATTRIBUTES and \
+                not isinstance(value, datetime.datetime):
+            if isinstance(value, datetime.date):
+                value = datetime.datetime(value.year, value.month, value.day)
+            else:
+                try:
+                    value = datetime.datetime.strptime(str(value), '%Y-%m-%d')
+                except ValueError:
+                    raise ValueError('{} should be YYYY-MM-DD'.format(key))
+        attributes[key] = value
+    return attributes
+
+
+def create_crawler(spec, **attrs):
+    """generate registered ETLCrawler subclass from spec
+
+    Args:
+        spec (dict): crawler spec
+        **attrs: extra class attributes, ex: override load_rows
+
+    Returns:
+        class: registered crawler class
+    """
+    validate_spec(spec)
+    class_attrs = get_crawler_attributes(spec)
+    class_attrs['spec'] = spec
+    # generated class belong to the module which call create_crawler
+    class_attrs['__module__'] = sys._getframe(1).f_globals['__name__']
+    class_attrs.update(attrs)
+    return ETLCrawlerRegistryHolder(
+        str(spec['name']), (SectionCrawler, ETLCrawler), class_attrs)
+
+
+def register_specs(spec_dir):
+    """generate crawlers from every spec file in directory
+
+    Args:
+        spec_dir (string): directory of .yaml/.yml/.json spec files
+
+    Returns:
+        List[class]: registered crawler classes
+    """
+    crawlers = []
+    module = sys._getframe(1).f_globals['__name__']
+    for file_name in sorted(os.listdir(spec_dir)):
+        if file_name.endswith(('.yaml', '.yml', '.json')):
+            crawlers.append(create_crawler(
+                load_spec(os.path.join(spec_dir, file_name)),
+                __module__=module))
+    return crawlers
+
+
+def url_file_name(url):
+    return hashlib.md5(url.encode('utf-8')).hexdigest() + '.html'
+
+
+def remove_text_newline(text):
+    return text.replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
+
+
+class SectionCrawler(object):
+    """shared execution engine of spec generated crawlers
+
+    it is mixed into classes generated by create_crawler,
+    it is not an ETLCrawler itself so it is not registered.
+    """
+    spec = None
+    file_root = FILE_ROOT
+    max_active_runs = 4
+
+    @ETLCrawler.register_extract(1)
+    def extract(self, ds, run_storage=None, **task_kwargs):
+        raw_dir = self._get_dir('raw', run_storage)
+        index_path = os.path.join(raw_dir, INDEX_FILE_NAME)
+        index = self._read_index(raw_dir)
+        for url, sections in self._crawl_listings().items():
+            entry = index.setdefault(url, {'file': url_file_name(url),
+                                           'sections': []})
+            entry['sections'] = sorted(set(entry['sections']) | sections)
+        self._write_json(index, index_path, run_storage)
+        # failed article is not marked, a retry fetch it again
+        checkpoint = run_storage.get_checkpoint() if run_storage else None
+        failed = 0
+        try:
+            for url in sorted(index):
+                if checkpoint and checkpoint.is_done(url):
+                    continue
+                path = os.path.join(raw_dir, index[url]['file'])
+                if not self._crawl_article(url, path, run_storage):
+                    failed += 1
+                elif checkpoint:
+                    checkpoint.mark(url)
+        finally:
+            if checkpoint:
+                checkpoint.close()
+        if failed:
+            logger.warn("%s skip %d failed articles",
+                        self.get_class_name(), failed)
+
+    @ETLCrawler.register_transform(1)
+    def transform(self, run_storage=None, *args, **kwargs):
+        raw_dir = self._get_dir('raw', run_storage)
+        csv_dir = self._get_dir('parser_csv', run_storage)
+        index = self._read_index(raw_dir)
+        buffers = {section: self.spill_buffer(run_storage)
+                   for section in self.spec['sections']}
+        try:
+            results = self.checkpoint_map(
+                lambda url: [url, self._parse_file(
+                    os.path.join(raw_dir, index[url]['file']))],
+                sorted(url for url in index if os.path.isfile(
+                    os.path.join(raw_dir, index[url]['file']))),
+                run_storage)
+            for url, row in results:
+                if not row:
+                    continue
+                for section in index[url]['sections']:
+                    if section in buffers:
+                        buffers[section].append(row)
+            for section, row_buffer in buffers.items():
+                self.write_csv(row_buffer, csv_dir, file_name=section,
+                               run_storage=run_storage)
+        finally:
+            for row_buffer in buffers.values():
+                row_buffer.close()
+
+    @ETLCrawler.register_load(1)
+    def load(self, run_storage=None, *args, **kwargs):
+        csv_dir = self._get_dir('parser_csv', run_storage)
+        for section in sorted(self.spec['sections']):
+            self.load_rows(section, self.pre_load(csv_dir, file_name=section))
+
+    def load_rows(self, section, rows):
+        """load rows of one section, override by create_crawler attrs
+
+        default only count rows.
+
+        Args:
+            section (string): section name
+            rows (collections.Iterable): csv rows
+        """
+        count = sum(1 for _ in rows)
+        logger.info("%s %s load %d rows", self.get_class_name(), section,
+                    count)
+
+    def _get_dir(self, name, run_storage=None):
+        return self.get_output_dir(
+            name, run_storage,
+            os.path.join(self.file_root, self.get_class_name(), name))
+
+    def _read_index(self, raw_dir):
+        index_path = os.path.join(raw_dir, INDEX_FILE_NAME)
+        if not os.path.isfile(index_path):
+            return {}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _write_json(self, data, path, run_storage=None):
+        with self.open_output(path, 'w', run_storage) as f:
+            json.dump(data, f)
+
+    def _fetch(self, url):
+        """fetch url, retry timeout and connection error
+
+        Raises:
+            requests.exceptions.RequestException: fetch failed
+        """
+        for retry in range(FETCH_RETRIES):
+            try:
+                result = requests.get(url, timeout=30)
+                result.raise_for_status()
+                return result.content
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError):
+                if retry == FETCH_RETRIES - 1:
+                    raise
+                time.sleep(random.randint(1, 5))
+
+    def _crawl_listings(self):
+        """fetch each listing page once and collect section links
+
+        Returns:
+            dict: {article url: set of section names}
+        """
+        base_url = self.spec.get('base_url')
+        soups = {}
+        links = {}
+        for section, section_spec in sorted(self.spec['sections'].items()):
+            listing_url = section_spec['url']
+            if listing_url not in soups:
+                soups[listing_url] = BeautifulSoup(self._fetch(listing_url),
+                                                   'lxml')
+            for a in soups[listing_url].select(section_spec['link_selector']):
+                href = a.get('href')
+                if not href:
+                    continue
+                url = urldefrag(urljoin(base_url or listing_url, href))[0]
+                links.setdefault(url, set()).add(section)
+        logger.info("%s found %d unique articles from %d listing pages",
+                    self.get_class_name(), len(links), len(soups))
+        return links
+
+    def _crawl_article(self, url, path, run_storage=None):
+        """fetch article to path, log and skip failed article
+
+        Returns:
+            bool: True if article is stored
+        """
+        try:
+            content = self._fetch(url)
+        except requests.exceptions.RequestException as e:
+            logger.error(url)
+            logger.error(e)
+            return False
+        with self.open_output(path, 'wb', run_storage) as f:
+            f.write(content)
+        return True
+
+    def _parse_file(self, file_path):
+        with open(file_path, 'r') as file:
+            try:
+                soup = BeautifulSoup(file, 'lxml')
+                layout_fields = self._get_layout_fields(soup)
+                return [self._extract_field(soup, self._get_field(
+                    field, layout_fields.get(field['name'])))
+                    for field in self.spec['fields']]
+            except Exception as e:
+                logger.error(file.name)
+                logger.error(e)
+                return None
+
+    def _get_field(self, field, layout_field=None):
+        if not layout_field:
+            return field
+        merged = {key: field[key] for key in FIELD_KEPT_KEYS if key in field}
+        merged.update(layout_field)
+        return merged
+
+    def _get_layout_fields(self, soup):
+        for layout in self.spec.get('layouts', []):
+            if soup.select_one(layout['match']) is not None:
+                return layout['fields']
+        return {}
+
+    def _extract_field(self, soup, field):
+        """return text of field
+
+        Raises:
+            ValueError: required field is empty
+        """
+        value = ''
+        if field.get('parse'):
+            value = getattr(self, field['parse'])(soup)
+            selectors = []
+        else:
+            selectors = field['selector']
+            if not isinstance(selectors, (list, tuple)):
+                selectors = [selectors]
+        attr = field.get('attr')
+        for selector in selectors:
+            if field.get('many'):
+                value = '\t'.join(
+                    element.get(attr, '') if attr else element.text
+                    for element in soup.select(selector))
+            else:
+                element = soup.select_one(selector)
+                if element is not None:
+                    value = element.get(attr, '') if attr else element.text
+            if value:
+                break
+        if value and field.get('split'):
+            value = value.split(field['split'])[0]
+        if not value and field.get('required'):
+            raise ValueError('field {} is required'.format(field['name']))
+        return remove_text_newline(value or field.get('default', ''))
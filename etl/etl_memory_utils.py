@@ -0,0 +1,162 @@
+# -*- encoding: utf8 -*-
+"""memory probes and memory bounded row buffer of ETL tasks"""
+import logging
+import os
+import pickle
+import resource
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+SPILL_CHECK_INTERVAL = 1000  # rows
+
+
+def get_rss(pid=None):
+    """return resident set size in bytes
+
+    read /proc/<pid>/statm, fallback to peak rss of current process
+    when /proc is not available.
+
+    Args:
+        pid (int, optional): process id, default is current process
+
+    Returns:
+        int: rss bytes
+    """
+    statm = '/proc/{}/statm'.format(pid or 'self')
+    try:
+        with open(statm, 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        if pid:
+            return 0
+        return get_peak_rss()
+
+
+def get_private_memory(pid=None):
+    """return private resident memory in bytes
+
+    pages still shared copy-on-write with the parent process are not
+    counted. sum Private_* of /proc/<pid>/smaps_rollup (smaps on kernel
+    before 4.14), fallback to rss when smaps is not available.
+
+    Args:
+        pid (int, optional): process id, default is current process
+
+    Returns:
+        int: private memory bytes
+    """
+    proc_dir = '/proc/{}'.format(pid or 'self')
+    for file_name in ('smaps_rollup', 'smaps'):
+        try:
+            total = 0
+            with open(os.path.join(proc_dir, file_name), 'r') as f:
+                for line in f:
+                    if line.startswith('Private_'):
+                        total += int(line.split()[1]) * 1024
+            return total
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return get_rss(pid)
+
+
+def get_hwm():
+    """return resident set size high-water mark of current process in bytes
+
+    read VmHWM of /proc/self/status, fallback to ru_maxrss.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return get_peak_rss()
+
+
+def get_peak_rss():
+    """return peak resident set size of current process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux report kilobytes, macOS report bytes
+    if os.uname()[0] == 'Darwin':
+        return peak
+    return peak * 1024
+
+
+class SpillBuffer(object):
+    """row buffer which spill rows to disk when memory near budget
+
+    rows are kept in memory, every SPILL_CHECK_INTERVAL rows the process
+    private memory is checked, buffered rows are pickled to spill file when
+    it is over spill_bytes. iterate buffer yield spilled rows first, then in-memory rows,
+    in the order they were appended.
+    """
+
+    def __init__(self, spill_dir=None, spill_bytes=None):
+        """
+        Args:
+            spill_dir (string, optional): directory of spill file,
+                                          default is system temp dir
+            spill_bytes (int, optional): spill when memory over this,
+                                         None means never spill
+        """
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self.spill_path = None
+        self.spilled = 0
+        self._rows = []
+        self._count = 0
+
+    def __len__(self):
+        return self.spilled + len(self._rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, row):
+        self._rows.append(row)
+        self._count += 1
+        if self.spill_bytes and self._count % SPILL_CHECK_INTERVAL == 0 \
+                and get_private_memory() > self.spill_bytes:
+            self.spill()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def spill(self):
+        """write in-memory rows to spill file"""
+        if not self._rows:
+            return
+        if self.spill_path is None:
+            if self.spill_dir and not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            fd, self.spill_path = tempfile.mkstemp(
+                suffix='.spill', dir=self.spill_dir)
+            os.close(fd)
+        with open(self.spill_path, 'ab') as f:
+            for row in self._rows:
+                pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+        logger.info("spill %d rows to %s", len(self._rows), self.spill_path)
+        self.spilled += len(self._rows)
+        self._rows = []
+
+    def __iter__(self):
+        if self.spill_path:
+            with open(self.spill_path, 'rb') as f:
+                for _ in range(self.spilled):
+                    yield pickle.load(f)
+        for row in self._rows:
+            yield row
+
+    def close(self):
+        """drop buffered rows and remove spill file"""
+        if self.spill_path and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+        self.spill_path = None
+        self.spilled = 0
+        self._rows = []
@@ -1,11 +1,16 @@
 # -*- encoding: utf8 -*-
 import datetime
 import inspect
+import json
 import logging
 import os
+import shutil
+import time
+from contextlib import contextmanager
 from functools import partial, wraps
 
 import unicodecsv as csv
+from etl_memory_utils import SpillBuffer
 
 DAILY_DELAY = 10800  # 3 hours
 WEEKLY_DELAY = 43200  # 12 hours
@@ -14,6 +19,14 @@ SEASONALLY_DELAY = 604800  # 7 days
 YEARLY_DELAY = 604800  # 7 days
 MAX_DELAY = 604800  # 7 days
 
+RUN_STORAGE_ROOT = os.getenv('ETL_RUN_STORAGE_ROOT',
+                             '/home/airflow/gcs/data/runs')
+RUN_STAGING_DIR = '.staging'
+RUN_CHECKPOINT_DIR = '.checkpoints'
+RUN_COMPLETE_FILE = '.complete'
+CHECKPOINT_SYNC_INTERVAL = 100  # items
+CHECKPOINT_SYNC_SECONDS = 10
+
 def add_task(task_type, task_priority):
     def decorator(func):
         @wraps(func)
@@ -64,6 +77,333 @@ def sort_tasks(tasks):
     return sorted(tasks, key=lambda task: task._task_priority)
 
 
+def mkdir_p(path):
+    """create directory and its parents, ignore existing directory
+
+    Args:
+        path (string): directory path
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def checkpoint_key(key):
+    """return hashable form of json serializable key
+
+    tuple and list key become the same string, dict key ignore order.
+    """
+    return json.dumps(key, sort_keys=True)
+
+
+class Checkpoint(object):
+    """durable progress marker of one task in one run
+
+    each finished item is appended as a json line {"key": .., "value": ..},
+    a retried task reload it and skip finished items.
+    broken trailing line (crash while writing) is ignored.
+    only keys and record offsets are kept in memory, values are read back
+    from the file when replayed.
+
+    fsync on every item is slow on GCS-FUSE, records are synced every
+    CHECKPOINT_SYNC_INTERVAL items or CHECKPOINT_SYNC_SECONDS, and on close.
+    items marked after the last sync are redone when the task crash.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (string): checkpoint file path
+        """
+        self.path = path
+        self._done = None
+        self._file = None
+        self._reader = None
+        self._size = 0
+        self._pending = 0
+        self._synced_at = time.time()
+
+    @property
+    def done(self):
+        """return finished items
+
+        Returns:
+            dict: {checkpoint_key(key): record offset} of finished items
+        """
+        if self._done is None:
+            self._done = {}
+            if os.path.isfile(self.path):
+                offset = 0
+                with open(self.path, 'rb') as f:
+                    for line in f:
+                        try:
+                            key = json.loads(line.decode('utf-8'))['key']
+                        except ValueError:
+                            key = None
+                        if key is not None:
+                            self._done[key] = offset
+                        offset += len(line)
+        return self._done
+
+    def is_done(self, key):
+        return checkpoint_key(key) in self.done
+
+    def get(self, key):
+        """return stored value of finished item, None if not finished"""
+        offset = self.done.get(checkpoint_key(key))
+        if offset is None:
+            return None
+        if self._file is not None:
+            self._file.flush()
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline().decode('utf-8'))['value']
+
+    def mark(self, key, value=None):
+        """mark item as finished
+
+        Args:
+            key: item key, should be json serializable
+            value (optional): item result, should be json serializable
+        """
+        done = self.done
+        key = checkpoint_key(key)
+        if self._file is None:
+            self._file = self._open_append()
+        # ensure_ascii keep str length equal to written bytes
+        line = json.dumps({'key': key, 'value': value}) + '\n'
+        self._file.write(line)
+        done[key] = self._size
+        self._size += len(line)
+        self._pending += 1
+        if self._pending >= CHECKPOINT_SYNC_INTERVAL or \
+                time.time() - self._synced_at > CHECKPOINT_SYNC_SECONDS:
+            self.sync()
+
+    def _open_append(self):
+        mkdir_p(os.path.dirname(self.path))
+        # terminate broken trailing line, or next record is lost with it
+        broken = False
+        self._size = 0
+        if os.path.isfile(self.path):
+            self._size = os.path.getsize(self.path)
+        if self._size:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                broken = f.read(1) != b'\n'
+        f = open(self.path, 'a')
+        if broken:
+            f.write('\n')
+            self._size += 1
+        return f
+
+    def sync(self):
+        """flush marked items to disk"""
+        if self._file is not None and self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+        self._synced_at = time.time()
+
+    def close(self):
+        """sync and close checkpoint file"""
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def clear(self):
+        """remove checkpoint, next run start from first item"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._done = None
+
+
+class RunStorage(object):
+    """run-scoped storage for one ETL task run
+
+    every DAG run of a crawler owns its own directory keyed by
+    crawler name and execution date, so overlapping runs never share files.
+    outputs are written into a staging directory keyed by try number and
+    renamed into the run directory on commit, a failed try never leaves
+    half-written files behind.
+
+    layout:
+        <root>/<crawler>/<run_key>/<name>
+        <root>/<crawler>/<run_key>/.staging/try_<try_number>/<name>
+        <root>/<crawler>/<run_key>/.checkpoints/<task_name>
+        <root>/<crawler>/<run_key>/.complete
+    """
+
+    def __init__(self, root, crawler_name, run_key, try_number=1,
+                 retention=None, task_name=None, failed_grace=None):
+        """
+        Args:
+            root (string): storage root directory
+            crawler_name (string): registered crawler class name
+            run_key (string): execution date as YYYYmmddTHHMMSS
+            try_number (int, optional): task try number, default is 1
+            retention (datetime.timedelta, optional): keep runs within
+                retention, None means keep all runs
+            task_name (string, optional): running task name,
+                default checkpoint name
+            failed_grace (datetime.timedelta, optional): how long a run
+                without completion marker may stay idle before it is
+                treated as failed, default is retention only
+        """
+        self.root = root
+        self.crawler_name = crawler_name
+        self.run_key = run_key
+        self.try_number = try_number
+        self.retention = retention
+        self.task_name = task_name
+        self.failed_grace = failed_grace or datetime.timedelta(0)
+
+    @property
+    def crawler_dir(self):
+        return os.path.join(self.root, self.crawler_name)
+
+    @property
+    def run_dir(self):
+        return os.path.join(self.crawler_dir, self.run_key)
+
+    @property
+    def staging_dir(self):
+        return os.path.join(self.run_dir, RUN_STAGING_DIR,
+                            'try_{}'.format(self.try_number))
+
+    def get_dir(self, *names):
+        """return directory inside run directory, create it if not exist
+
+        Args:
+            *names (List[string]): sub directory names
+
+        Returns:
+            string: directory path
+        """
+        path = os.path.join(self.run_dir, *names)
+        mkdir_p(path)
+        return path
+
+    @contextmanager
+    def atomic_write(self, path, mode='wb'):
+        """open staging file and move it to path when block succeed
+
+        Args:
+            path (string): final file path, should be inside run directory
+            mode (string, optional): file open mode, default is 'wb'
+
+        Raises:
+            ValueError: path is not inside run directory
+
+        Yields:
+            file: staging file object
+        """
+        rel_path = os.path.relpath(os.path.abspath(path),
+                                   os.path.abspath(self.run_dir))
+        if rel_path == os.curdir or rel_path == os.pardir or \
+                rel_path.startswith(os.pardir + os.sep):
+            raise ValueError('{} is not inside run directory {}'.format(
+                path, self.run_dir))
+        staging_path = os.path.join(self.staging_dir, rel_path)
+        mkdir_p(os.path.dirname(staging_path))
+        mkdir_p(os.path.dirname(path))
+        try:
+            with open(staging_path, mode) as f:
+                yield f
+        except Exception:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+            raise
+        os.rename(staging_path, path)
+
+    def get_checkpoint(self, name=None):
+        """return checkpoint of task in this run
+
+        checkpoint is not keyed by try number, retries of the same task
+        share it.
+
+        Args:
+            name (string, optional): checkpoint name, default is task_name
+
+        Returns:
+            Checkpoint: checkpoint of task
+        """
+        name = name or self.task_name
+        if not name:
+            raise ValueError('checkpoint name is required')
+        return Checkpoint(os.path.join(self.run_dir, RUN_CHECKPOINT_DIR,
+                                       name + '.jsonl'))
+
+    def discard_staging(self):
+        """remove staging files of every try in this run"""
+        shutil.rmtree(os.path.join(self.run_dir, RUN_STAGING_DIR),
+                      ignore_errors=True)
+
+    def mark_complete(self):
+        """write completion marker, run is only removed by cleanup after it"""
+        mkdir_p(self.run_dir)
+        with open(os.path.join(self.run_dir, RUN_COMPLETE_FILE), 'w') as f:
+            f.write(self.run_key)
+
+    def _get_last_modified(self, path):
+        last_modified = os.path.getmtime(path)
+        for dir_path, dir_names, file_names in os.walk(path):
+            for name in dir_names + file_names:
+                try:
+                    last_modified = max(last_modified, os.path.getmtime(
+                        os.path.join(dir_path, name)))
+                except OSError:
+                    continue
+        return last_modified
+
+    def cleanup(self, now=None):
+        """remove expired run directories
+
+        completed run's age is measured from its completion marker.
+        run without marker is still active or has failed, its age is
+        measured from its newest file and it expires after
+        retention + failed_grace, an active run keeps touching files so it
+        is never removed, whatever its execution date is.
+
+        Args:
+            now (float, optional): reference unix time, default is now
+
+        Returns:
+            List[string]: removed run directories
+        """
+        removed = []
+        if self.retention is None or not os.path.isdir(self.crawler_dir):
+            return removed
+        now = now or time.time()
+        for run_key in os.listdir(self.crawler_dir):
+            # skip current run and crawler level dirs, ex: .profiles
+            if run_key == self.run_key or run_key.startswith('.'):
+                continue
+            path = os.path.join(self.crawler_dir, run_key)
+            expire = self.retention
+            try:
+                modified = os.path.getmtime(
+                    os.path.join(path, RUN_COMPLETE_FILE))
+            except OSError:
+                try:
+                    modified = self._get_last_modified(path)
+                except OSError:
+                    continue
+                expire = self.retention + self.failed_grace
+            if now - modified > expire.total_seconds():
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+        return removed
+
+
 class ETLRegistryHolder(type):
     """ETLBase register 
 
@@ -246,6 +586,8 @@ class ETLCrawler(ETLBase):
     {{ execution_date }}    the execution_date, (datetime.datetime)
     {{ end_date }}    same as {{ ds }}
     {{ latest_date }}    same as {{ ds }}
+    {{ run_storage }}    RunStorage scoped to crawler, execution date, try
+                         use checkpoint_iter/checkpoint_map to resume retries
     """
     __metaclass__ = ETLCrawlerRegistryHolder
 
@@ -254,6 +596,17 @@ class ETLCrawler(ETLBase):
     retry_delay_time = datetime.timedelta(hours=2)
     start_date = datetime.datetime(2017, 12, 25)
     execution_timeout = datetime.timedelta(hours=2)
+    # keep 1 unless every task write through run_storage,
+    # overlapping runs clobber fixed paths.
+    max_active_runs = 1
+    run_storage_root = RUN_STORAGE_ROOT
+    run_retention = datetime.timedelta(days=7)
+    # memory budget of each task in MB, None means no limit.
+    # task run in subprocess capped by RLIMIT_DATA and killed when its
+    # private memory is over budget, spill_buffer spill rows to disk when
+    # private memory is over memory_spill_ratio of budget.
+    memory_limit_mb = None
+    memory_spill_ratio = 0.8
 
     @classmethod
     def get_timedelta_delay(cls):
@@ -274,6 +627,159 @@ class ETLCrawler(ETLBase):
         except Exception as e:
             return None
 
+    def get_run_storage(self, execution_date, try_number=1, task_name=None):
+        """return run-scoped storage of this crawler
+
+        Args:
+            execution_date (datetime.datetime): DAG run execution date
+            try_number (int, optional): task try number, default is 1
+            task_name (string, optional): running task name, default is None
+
+        Returns:
+            RunStorage: storage keyed by crawler, execution date and try
+        """
+        return RunStorage(self.run_storage_root, self.get_class_name(),
+                          execution_date.strftime('%Y%m%dT%H%M%S'),
+                          try_number=try_number,
+                          retention=self.run_retention,
+                          task_name=task_name,
+                          failed_grace=self.get_failed_grace())
+
+    def get_output_dir(self, name, run_storage=None, default=None):
+        """return output directory, create it if not exist
+
+        Args:
+            name (string): directory name inside run storage
+            run_storage (RunStorage): run storage, default is None
+            default (string): fixed path used without run storage
+
+        Returns:
+            string: directory path
+        """
+        if run_storage:
+            return run_storage.get_dir(name)
+        mkdir_p(default)
+        return default
+
+    def open_output(self, path, mode='wb', run_storage=None):
+        """open output file, write atomically through run storage if given
+
+        Args:
+            path (string): file path
+            mode (string, optional): file open mode, default is 'wb'
+            run_storage (RunStorage): run storage, default is None
+
+        Returns:
+            file: context manager of writable file
+        """
+        if run_storage:
+            return run_storage.atomic_write(path, mode)
+        return open(path, mode)
+
+    def get_failed_grace(self):
+        """return how long an unfinished run may stay idle before it is
+        treated as failed, every try may run execution_timeout and wait
+        retry_delay_time"""
+        return (self.execution_timeout + self.retry_delay_time) * \
+            (self.retries + 1)
+
+    def get_memory_limit(self):
+        """return memory budget of each task in bytes, None means no limit"""
+        if not self.memory_limit_mb:
+            return None
+        return int(self.memory_limit_mb * 1024 * 1024)
+
+    def spill_buffer(self, run_storage=None):
+        """return row buffer bounded by memory budget
+
+        Args:
+            run_storage (RunStorage): spill into run staging directory,
+                                      default is system temp dir
+
+        Returns:
+            SpillBuffer: row buffer
+        """
+        spill_bytes = None
+        memory_limit = self.get_memory_limit()
+        if memory_limit:
+            spill_bytes = int(memory_limit * self.memory_spill_ratio)
+        spill_dir = None
+        if run_storage:
+            spill_dir = os.path.join(run_storage.staging_dir, 'spill')
+        return SpillBuffer(spill_dir, spill_bytes)
+
+    def checkpoint_iter(self, items, run_storage=None, key=None, name=None):
+        """iterate items which not finished in previous tries
+
+        item is marked finished when the caller ask for next item,
+        so item which raise error in loop body is retried next time.
+
+        Args:
+            items (collections.Iterable): items to process
+            run_storage (RunStorage): run storage, iterate all items if None
+            key (function, optional): item -> json serializable key,
+                                      default is item itself
+            name (string, optional): checkpoint name, default is task name
+
+        Returns:
+            collections.Iterable: unfinished items
+        """
+        if not run_storage:
+            for item in items:
+                yield item
+            return
+        key = key or (lambda item: item)
+        checkpoint = run_storage.get_checkpoint(name)
+        skipped = 0
+        try:
+            for item in items:
+                item_key = key(item)
+                if checkpoint.is_done(item_key):
+                    skipped += 1
+                    continue
+                yield item
+                checkpoint.mark(item_key)
+        finally:
+            checkpoint.close()
+        if skipped:
+            logger.info("%s skip %d finished items", checkpoint.path, skipped)
+
+    def checkpoint_map(self, func, items, run_storage=None, key=None,
+                       name=None):
+        """apply func to items, reuse results from previous tries
+
+        func result is stored in checkpoint, it should be json serializable.
+        tuple result come back as list on resume.
+
+        Args:
+            func (function): item -> result
+            items (collections.Iterable): items to process
+            run_storage (RunStorage): run storage, apply to all items if None
+            key (function, optional): item -> json serializable key,
+                                      default is item itself
+            name (string, optional): checkpoint name, default is task name
+
+        Returns:
+            collections.Iterable: result of each item
+        """
+        if not run_storage:
+            for item in items:
+                yield func(item)
+            return
+        key = key or (lambda item: item)
+        checkpoint = run_storage.get_checkpoint(name)
+        try:
+            for item in items:
+                item_key = key(item)
+                if checkpoint.is_done(item_key):
+                    yield checkpoint.get(item_key)
+                    continue
+                result = func(item)
+                checkpoint.mark(item_key, result)
+                yield result
+        finally:
+            checkpoint.close()
+
     def pre_load(self, file_dir,file_name=None, *args, **kwargs):
         """load transformed data        
 
@@ -299,7 +805,8 @@ class ETLCrawler(ETLBase):
             for row in reader:
                 yield [x or None for x in row]
 
-    def write_csv(self, file, file_dir,file_name=None, *args, **kwargs):
+    def write_csv(self, file, file_dir,file_name=None, run_storage=None,
+                  *args, **kwargs):
         """write data which encoding with utf-8
 
         file should be csv form.
@@ -310,13 +817,16 @@ class ETLCrawler(ETLBase):
             file (List[data]): file should be csv form.
             file_name (Str): csv file name, should pair with pre_load, 
                              default is None
+            run_storage (RunStorage): write through run storage staging,
+                                      file only appear when write succeed,
+                                      default is None
         """
         filename = os.path.join(
             file_dir, self.get_class_name() + '.csv')
         if file_name:
             filename = os.path.join(
                 file_dir, file_name + '.csv')
-        with open(filename, 'wb') as wfile:
+        with self.open_output(filename, 'wb', run_storage) as wfile:
             wr = csv.writer(wfile, encoding='utf-8',
                             delimiter='|',
                             quoting=csv.QUOTE_NONE,
@@ -0,0 +1,44 @@
+from crawler_template import create_crawler
+
+NEW_YORK_TIMES_SECTIONS_SPEC = {
+    'name': 'new_york_times_sections',
+    'execute_cron_time': '00 20 * * *',
+    'memory_limit_mb': 1024,
+    'base_url': 'https://www.nytimes.com',
+    'sections': {
+        'dealbook': {
+            'url': 'https://www.nytimes.com/section/business/dealbook',
+            'link_selector': 'section#collection-business-dealbook section li a',
+        },
+        'energy_environment': {
+            'url': 'https://www.nytimes.com/section/business/energy-environment',
+            'link_selector': 'section#collection-business-energy-environment section li a',
+        },
+    },
+    'fields': [
+        {'name': 'sub_section',
+         'selector': ['div[class^="SectionBar-sectionBarHeading"]',
+                      'span.kicker-label a']},
+        {'name': 'title',
+         'selector': ['h1 span', '.interactive-headline', '#headline']},
+        {'name': 'author',
+         'selector': ['a[class^="Byline-bylineAuthor"]',
+                      'p[itemprop="author creator"] span[itemprop="name"]',
+                      'span.byline-author']},
+        {'name': 'tx_dt', 'selector': 'meta[itemprop=dateModified]',
+         'attr': 'content', 'split': 'T'},
+        {'name': 'publish_date', 'selector': 'meta[itemprop=datePublished]',
+         'attr': 'content', 'split': 'T'},
+        {'name': 'context', 'many': True,
+         'selector': ['article#story header ~ p',
+                      'article#story div.StoryBodyCompanionColumn p',
+                      'p.g-body',
+                      'p.story-body-text.story-content']},
+        {'name': 'url', 'selector': 'html', 'attr': 'itemid',
+         'required': True},
+        {'name': 'outline', 'selector': 'meta[itemprop=description]',
+         'attr': 'content'},
+    ],
+}
+
+new_york_times_sections = create_crawler(NEW_YORK_TIMES_SECTIONS_SPEC)
@@ -7,6 +7,7 @@ import pprint
 import re
 import time
 from datetime import timedelta
+from functools import partial
 
 from airflow import DAG
 from airflow.hooks.base_hook import BaseHook
@@ -18,6 +19,8 @@ from airflow.operators.python_operator import (BranchPythonOperator,
                                                ShortCircuitOperator)
 from airflow.utils.dates import cron_presets
 from airflow.utils.helpers import chain
+from utils.etl_memory import run_with_memory_limit
+from utils.etl_profile import PROFILE_DIR, profile_call, should_profile
 from utils.etl_utils import get_registered_etl, get_registered_etl_from_name
 from pendulum import datetime
 from sqlalchemy import desc, or_
@@ -49,7 +52,13 @@ default_args = {
 }
 
 
-def call_cls_method(cls_method, *args, **kwargs):
+def call_cls_method(cls_method, is_last_task=False, *args, **kwargs):
+    # run storage is keyed by the dag run's own execution_date,
+    # every task of the same run shares it.
+    run_storage = cls_method.__self__.get_run_storage(
+        kwargs[u'execution_date'], kwargs[u'ti'].try_number,
+        cls_method.__name__)
+    kwargs[u'run_storage'] = run_storage
     # next_execution_date mean doing day in ETL.
     next_date = kwargs[u'next_execution_date']
     if next_date >= datetime.now():
@@ -58,15 +67,46 @@ def call_cls_method(cls_method, *args, **kwargs):
     kwargs[u'ds_nodash'] = next_date.strftime("%Y%m%d")
     kwargs[u'execution_date'] = next_date
     logger.info(kwargs)
-    cls_method(*args, **kwargs)
-
-
-def create_python_task(task, dag, pool=None):
+    etl = cls_method.__self__
+    etl_name = etl.get_class_name()
+    dag_run = kwargs.get(u'dag_run')
+    run_task = cls_method
+    if should_profile(etl_name, cls_method.__name__,
+                      getattr(dag_run, 'conf', None)):
+        # <root>/<crawler>/.profiles/<run_key>, out of run cleanup reach
+        profile_dir = os.path.join(run_storage.crawler_dir, PROFILE_DIR,
+                                   run_storage.run_key)
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        output_prefix = os.path.join(
+            profile_dir,
+            '{}.try_{}'.format(cls_method.__name__, run_storage.try_number))
+        run_task = partial(profile_call, cls_method, output_prefix)
+    memory_limit = etl.get_memory_limit()
+    if memory_limit:
+        peak_memory = run_with_memory_limit(run_task, memory_limit,
+                                            *args, **kwargs)
+        logger.info('%s.%s peak private memory %d bytes, limit %d bytes',
+                    etl_name, cls_method.__name__, peak_memory, memory_limit)
+        kwargs[u'ti'].xcom_push(key='peak_memory', value=peak_memory)
+    else:
+        run_task(*args, **kwargs)
+    # task finished, a manual re-run should start from scratch.
+    run_storage.get_checkpoint().clear()
+    # last task of the chain finish the run.
+    if is_last_task:
+        run_storage.discard_staging()
+        run_storage.mark_complete()
+        for path in run_storage.cleanup():
+            logger.info('remove expired run storage %s', path)
+
+
+def create_python_task(task, dag, pool=None, is_last_task=False):
     python_task = PythonOperator(
         task_id='{task_name}'.format(task_name=task.__name__),
         provide_context=True,
         python_callable=call_cls_method,
-        op_kwargs={'cls_method': task},
+        op_kwargs={'cls_method': task, 'is_last_task': is_last_task},
         pool=pool,
         dag=dag)
     return python_task
@@ -95,7 +135,7 @@ def time_delay_trigger(context, dag_run_obj, *args, **kwargs):
     return dag_run_obj
 
 
-def create_ETLDag(etl_name, cron_time, etl_task_list):
+def create_ETLDag(etl_name, cron_time, etl_task_list, max_active_runs=1):
     dag_id = '{action_type}_{etl_name}'.format(
         action_type="ETL",
         etl_name=etl_name)
@@ -104,11 +144,12 @@ def create_ETLDag(etl_name, cron_time, etl_task_list):
 
     dag = DAG(dag_id=dag_id, default_args=default_args,
               schedule_interval=cron_time,
-              max_active_runs=1,
+              max_active_runs=max_active_runs,
               concurrency=8,
               catchup=AIRFLOW_BACKFILL)
     deploy_task_list = [create_python_task(
-        task, dag) for task in etl_task_list]
+        task, dag, is_last_task=task is etl_task_list[-1])
+        for task in etl_task_list]
 
     chain(*deploy_task_list)
 
@@ -124,5 +165,6 @@ for etl_name, etl_class in etl_dict.items():
 
     etl_cron_time = fix_crontime_onlyhour(etl.execute_cron_time)
 
-    ETL_dag_id, ETL_dag = create_ETLDag(etl_name, etl_cron_time, etl_task_list)
+    ETL_dag_id, ETL_dag = create_ETLDag(etl_name, etl_cron_time, etl_task_list,
+                                        etl.max_active_runs)
     globals()[ETL_dag_id] = ETL_dag
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""run registered ETL task under memory budget
+
+task run in a forked subprocess, so one crawler can not OOM-kill a shared
+worker. memory is measured as the child's private memory, pages shared
+copy-on-write with the worker are not counted.
+
+    - the child cap its new private writable memory with RLIMIT_DATA,
+      allocation over budget fail with MemoryError in the child.
+    - the parent poll the child's private memory as a backstop and kill it
+      when it is over budget.
+    - peak is the child's own rss high-water mark minus its rss at fork,
+      or the polled peak when it is higher.
+"""
+import logging
+import multiprocessing
+import re
+import resource
+import traceback
+
+from etl.etl_memory_utils import get_hwm, get_private_memory, get_rss
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1  # seconds
+
+
+class MemoryLimitExceeded(MemoryError):
+    pass
+
+
+def _get_context():
+    # task kwargs (airflow context) are not picklable, child must be forked.
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing
+    return get_context('fork')
+
+
+def _get_vm_data():
+    """return VmData (private writable mappings) of current process in bytes,
+    None when /proc is not available"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            match = re.search(r'^VmData:\s+(\d+) kB', f.read(), re.M)
+    except (IOError, OSError):
+        return None
+    if not match:
+        return None
+    return int(match.group(1)) * 1024
+
+
+def _limit_data(memory_limit):
+    """cap private writable memory of current process
+
+    RLIMIT_DATA count mappings inherited from the parent too,
+    budget is added on top of what the child start with.
+    """
+    vm_data = _get_vm_data()
+    if vm_data is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    soft = vm_data + memory_limit
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
+
+
+def _run_child(conn, func, memory_limit, args, kwargs):
+    # rss at fork is what the child share with the parent
+    baseline = get_rss()
+    error = None
+    memory_error = False
+    try:
+        _limit_data(memory_limit)
+        func(*args, **kwargs)
+    except MemoryError:
+        memory_error = True
+        error = traceback.format_exc()
+    except BaseException:
+        error = traceback.format_exc()
+    conn.send((error, memory_error, max(get_hwm() - baseline, 0)))
+    conn.close()
+
+
+def run_with_memory_limit(func, memory_limit, *args, **kwargs):
+    """call func in subprocess limited to memory_limit of private memory
+
+    Args:
+        func (function): task to run
+        memory_limit (int): memory budget in bytes
+
+    Raises:
+        MemoryLimitExceeded: subprocess memory over memory_limit
+        RuntimeError: func raise error or subprocess exit abnormally
+
+    Returns:
+        int: peak private memory of subprocess in bytes
+    """
+    name = getattr(func, '__name__', func)
+    context = _get_context()
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_run_child,
+        args=(child_conn, func, memory_limit, args, kwargs))
+    process.start()
+    child_conn.close()
+    peak = 0
+    while process.is_alive():
+        memory = get_private_memory(process.pid)
+        peak = max(peak, memory)
+        if memory > memory_limit:
+            process.terminate()
+            process.join()
+            raise MemoryLimitExceeded(
+                '{} use {} bytes, over memory limit {} bytes'.format(
+                    name, memory, memory_limit))
+        # result should be read before join, large message block the child.
+        if parent_conn.poll(POLL_INTERVAL):
+            break
+    error = None
+    memory_error = False
+    if parent_conn.poll():
+        try:
+            error, memory_error, child_peak = parent_conn.recv()
+            peak = max(peak, child_peak)
+        except EOFError:  # child died before report
+            pass
+    process.join()
+    if memory_error:
+        raise MemoryLimitExceeded(
+            '{} over memory limit {} bytes\n{}'.format(
+                name, memory_limit, error))
+    if error:
+        raise RuntimeError(error)
+    if process.exitcode != 0:
+        raise RuntimeError('{} exit with code {}'.format(
+            name, process.exitcode))
+    return peak
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""profile registered ETL task and aggregate hotspots
+
+profiling is switched on by env var or DAG conf, value is comma-separated
+list of `<crawler>` or `<crawler>.<task>`, `*` means every task.
+
+    ETL_PROFILE=new_york_times_economy.transform
+    airflow trigger_dag ETL_new_york_times_economy -c '{"profile": "*"}'
+
+ETL_PROFILER choose profiler, `cprofile` (default) write pstats `.prof`
+which can be rendered by flameprof/snakeviz, `pyinstrument` write
+speedscope json when pyinstrument is installed.
+
+aggregate hotspots across runs and crawlers:
+
+    python -m utils.etl_profile /home/airflow/gcs/data/runs --top 20
+"""
+import argparse
+import cProfile
+import fnmatch
+import json
+import logging
+import os
+import pstats
+import sys
+from collections import defaultdict
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    PyinstrumentProfiler = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = 'ETL_PROFILE'
+PROFILER_ENV = 'ETL_PROFILER'
+PROFILE_CONF_KEY = 'profile'
+# profiles live outside run directories, so run cleanup keep them
+PROFILE_DIR = '.profiles'
+PROFILE_EXTENSION = '.prof'
+SPEEDSCOPE_EXTENSION = '.speedscope.json'
+PROFILE_EXTENSIONS = (PROFILE_EXTENSION, SPEEDSCOPE_EXTENSION)
+
+
+def _split_names(value):
+    if not value:
+        return []
+    if value is True:
+        return ['*']
+    if isinstance(value, (list, tuple)):
+        return [name for name in value if name]
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def should_profile(crawler_name, task_name, conf=None):
+    """check if task is switched on by env var or DAG conf
+
+    Args:
+        crawler_name (string): registered crawler name
+        task_name (string): registered task name
+        conf (dict, optional): DAG run conf, default is None
+
+    Returns:
+        bool: True if task should be profiled
+    """
+    names = _split_names(os.getenv(PROFILE_ENV))
+    if conf:
+        names += _split_names(conf.get(PROFILE_CONF_KEY))
+    targets = (crawler_name, '{}.{}'.format(crawler_name, task_name))
+    return any(fnmatch.fnmatch(target, name)
+               for name in names for target in targets)
+
+
+def profile_call(func, output_prefix, *args, **kwargs):
+    """call func under profiler and dump result
+
+    Args:
+        func (function): function to profile
+        output_prefix (string): output path without extension
+
+    Returns:
+        object: return value of func
+    """
+    profiler_name = os.getenv(PROFILER_ENV, 'cprofile')
+    if profiler_name == 'pyinstrument':
+        if PyinstrumentProfiler is not None:
+            return _pyinstrument_call(func, output_prefix, *args, **kwargs)
+        logger.warn("pyinstrument is not installed, fallback to cProfile.")
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        output_path = output_prefix + PROFILE_EXTENSION
+        profiler.dump_stats(output_path)
+        logger.info("write profile %s", output_path)
+
+
+def _pyinstrument_call(func, output_prefix, *args, **kwargs):
+    profiler = PyinstrumentProfiler()
+    profiler.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.stop()
+        output_path = output_prefix + SPEEDSCOPE_EXTENSION
+        with open(output_path, 'w') as f:
+            f.write(profiler.output(renderer=SpeedscopeRenderer()))
+        logger.info("write profile %s", output_path)
+
+
+def find_profiles(root, crawlers=None, tasks=None):
+    """find profile dumps under run storage root
+
+    layout: <root>/<crawler>/.profiles/<run_key>/<task>.try_<n>.<ext>
+    ext is `prof` (cProfile) or `speedscope.json` (pyinstrument)
+
+    Args:
+        root (string): run storage root
+        crawlers (List[string], optional): keep these crawlers only
+        tasks (List[string], optional): keep these tasks only
+
+    Returns:
+        List[tuple]: (crawler, task, path)
+    """
+    profiles = []
+    if not os.path.isdir(root):
+        return profiles
+    for crawler in sorted(os.listdir(root)):
+        if crawlers and crawler not in crawlers:
+            continue
+        profile_root = os.path.join(root, crawler, PROFILE_DIR)
+        if not os.path.isdir(profile_root):
+            continue
+        for run_key in sorted(os.listdir(profile_root)):
+            profile_dir = os.path.join(profile_root, run_key)
+            if not os.path.isdir(profile_dir):
+                continue
+            for file_name in sorted(os.listdir(profile_dir)):
+                if not file_name.endswith(PROFILE_EXTENSIONS):
+                    continue
+                task = file_name.split('.')[0]
+                if tasks and task not in tasks:
+                    continue
+                profiles.append(
+                    (crawler, task, os.path.join(profile_dir, file_name)))
+    return profiles
+
+
+def _load_pstats(path, totals):
+    stats = pstats.Stats(path)
+    for (file_name, line, func_name), (_, ncalls, tottime, cumtime, _) in \
+            stats.stats.items():
+        total = totals[_function_name(file_name, line, func_name)]
+        total[0] += ncalls
+        total[1] += tottime
+        total[2] += cumtime
+
+
+def _load_speedscope(path, totals):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    frames = [_function_name(frame.get('file', '~'), frame.get('line', 0),
+                             frame['name'])
+              for frame in data['shared']['frames']]
+    for profile in data['profiles']:
+        if profile['type'] == 'evented':
+            stack = []  # [function, open at, child time]
+            for event in profile['events']:
+                if event['type'] == 'O':
+                    stack.append([frames[event['frame']], event['at'], 0.0])
+                    continue
+                function, opened, child = stack.pop()
+                duration = event['at'] - opened
+                total = totals[function]
+                total[0] += 1
+                total[1] += duration - child
+                # recursive frame is counted once in cumtime
+                if function not in [entry[0] for entry in stack]:
+                    total[2] += duration
+                if stack:
+                    stack[-1][2] += duration
+        elif profile['type'] == 'sampled':
+            for sample, weight in zip(profile['samples'],
+                                      profile['weights']):
+                if not sample:
+                    continue
+                functions = [frames[index] for index in sample]
+                totals[functions[-1]][1] += weight
+                for function in set(functions):
+                    totals[function][0] += 1
+                    totals[function][2] += weight
+
+
+def _function_name(file_name, line, func_name):
+    return '{}:{}({})'.format(file_name, line, func_name)
+
+
+def aggregate_hotspots(paths, top=20, sort_by='tottime'):
+    """merge profiles and return top functions
+
+    pyinstrument profiles are sampled, their ncalls is the number of
+    frame openings, not real calls.
+
+    Args:
+        paths (List[string]): cProfile or speedscope dump paths
+        top (int, optional): number of functions, default is 20
+        sort_by (string, optional): tottime or cumtime, default is tottime
+
+    Returns:
+        List[tuple]: (function, ncalls, tottime, cumtime, tottime share)
+    """
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for path in paths:
+        if path.endswith(SPEEDSCOPE_EXTENSION):
+            _load_speedscope(path, totals)
+        else:
+            _load_pstats(path, totals)
+    total = sum(tottime for _, tottime, _ in totals.values()) or 1.0
+    rows = [(function, ncalls, tottime, cumtime, tottime / total)
+            for function, (ncalls, tottime, cumtime) in totals.items()]
+    index = 3 if sort_by == 'cumtime' else 2
+    rows.sort(key=lambda row: row[index], reverse=True)
+    return rows[:top]
+
+
+def print_hotspots(title, rows, out=sys.stdout):
+    out.write('== {}\n'.format(title))
+    out.write('{:>10} {:>10} {:>10} {:>7}  {}\n'.format(
+        'ncalls', 'tottime', 'cumtime', 'share', 'function'))
+    for function, ncalls, tottime, cumtime, share in rows:
+        out.write('{:>10} {:>10.3f} {:>10.3f} {:>6.1f}%  {}\n'.format(
+            ncalls, tottime, cumtime, share * 100, function))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='aggregate ETL task profiles across runs and crawlers')
+    parser.add_argument('root', help='run storage root')
+    parser.add_argument('--crawler', action='append',
+                        help='crawler name, can repeat')
+    parser.add_argument('--task', action='append',
+                        help='task name, can repeat')
+    parser.add_argument('--group-by', choices=['all', 'crawler', 'task'],
+                        default='all')
+    parser.add_argument('--sort', choices=['tottime', 'cumtime'],
+                        default='tottime')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    profiles = find_profiles(args.root, args.crawler, args.task)
+    if not profiles:
+        sys.stderr.write('no profile found under {}\n'.format(args.root))
+        return 1
+    groups = defaultdict(list)
+    for crawler, task, path in profiles:
+        if args.group_by == 'crawler':
+            groups[crawler].append(path)
+        elif args.group_by == 'task':
+            groups['{}.{}'.format(crawler, task)].append(path)
+        else:
+            groups['all'].append(path)
+    for title in sorted(groups):
+        paths = groups[title]
+        rows = aggregate_hotspots(paths, args.top, args.sort)
+        print_hotspots('{} ({} profiles)'.format(title, len(paths)), rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())